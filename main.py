@@ -10,10 +10,20 @@ from telegram.ext import (
 )
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession, Request
+from requests.adapters import HTTPAdapter
+import asyncio
 import datetime
+import heapq
 import logging
 import json
-from typing import List
+import time
+from typing import List, NamedTuple, Optional
+
+try:
+    import pandas as pd  # Optional: vectorizes report filtering for large sheets
+except ImportError:
+    pd = None
 
 # --- Load Configurations from External File ---
 CONFIG_FILE = 'config.json'  # Path to the configuration file
@@ -24,6 +34,9 @@ BOT_TOKEN = config['BOT_TOKEN']
 SPREADSHEET_ID = config['SPREADSHEET_ID']
 SHEET_NAME = config['SHEET_NAME']
 ALLOWED_USER_IDS = config.get('ALLOWED_USER_IDS', []) # Get whitelist from config, default to empty list
+WEBHOOK_URL = config.get('WEBHOOK_URL') # Optional: public https URL; when set the bot uses webhooks instead of polling
+WEBHOOK_PORT = config.get('WEBHOOK_PORT', 8443)
+WEBHOOK_SECRET = config.get('WEBHOOK_SECRET') # Optional: secret token Telegram echoes back on each webhook request
 
 # --- Divider Symbol (configurable via bot) ---
 divider_symbol = '$'
@@ -36,18 +49,83 @@ logger = logging.getLogger(__name__)
 
 
 # --- Google Sheets Authentication ---
+SHEETS_TIMEOUT = 10  # Seconds before a hung Sheets call is abandoned instead of stalling its worker thread
+TOKEN_CACHE_FILE = '.gsheets_token.json'  # Access token cached across restarts, shared by co-located workers
+
+def _load_cached_token(creds) -> bool:
+    """Reuse a previously fetched access token if it hasn't expired."""
+    try:
+        with open(TOKEN_CACHE_FILE, 'r') as token_file:
+            cached = json.load(token_file)
+        expiry = datetime.datetime.fromisoformat(cached['expiry'])
+        if expiry > datetime.datetime.utcnow() + datetime.timedelta(minutes=1):
+            creds.token = cached['token']
+            creds.expiry = expiry
+            return True
+    except (OSError, ValueError, KeyError):
+        pass # Missing or stale cache; fall through to a fresh token exchange
+    return False
+
+def _save_cached_token(creds):
+    try:
+        with open(TOKEN_CACHE_FILE, 'w') as token_file:
+            json.dump({'token': creds.token, 'expiry': creds.expiry.isoformat()}, token_file)
+    except OSError as e:
+        logger.warning(f"Could not cache Sheets token: {e}")
+
 def authenticate_gspread():
     scopes = [
         'https://www.googleapis.com/auth/spreadsheets',
         'https://www.googleapis.com/auth/drive',
     ]
     creds = Credentials.from_service_account_file(config['CREDENTIALS_FILE'], scopes=scopes)
-    gc = gspread.authorize(creds)
+    if not _load_cached_token(creds):
+        creds.refresh(Request()) # One JWT exchange, then the token is reused until expiry
+        _save_cached_token(creds)
+    session = AuthorizedSession(creds)
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4)) # Keep TLS connections warm and shared across concurrent calls
+    gc = gspread.Client(auth=creds, session=session) # Client(auth, session) works on gspread 5.x and 6.x; authorize(session=...) is 6.x-only
+    gc.set_timeout(SHEETS_TIMEOUT)
     return gc
 
 gc = authenticate_gspread()  # Authenticate once at startup
 sheet = gc.open_by_key(SPREADSHEET_ID).worksheet(SHEET_NAME)
 
+# --- Sheet Data Cache ---
+_sheet_cache = {'data': None, 'ts': 0.0, 'ttl': 30.0, 'gen': 0}  # TTL cache for get_all_values, avoids re-downloading the sheet on every command
+
+def _get_all_values_cached():
+    """Return sheet.get_all_values(), reusing a recent result within the TTL."""
+    if _sheet_cache['data'] is not None and time.monotonic() - _sheet_cache['ts'] < _sheet_cache['ttl']:
+        return _sheet_cache['data']
+    gen = _sheet_cache['gen']
+    data = sheet.get_all_values()
+    if gen == _sheet_cache['gen']: # Discard the snapshot if a write invalidated the cache while we were fetching
+        _sheet_cache['data'] = data
+        _sheet_cache['ts'] = time.monotonic()
+    return data
+
+def _col_values_cached(col: int) -> List[str]:
+    """Column values served from the cached sheet data (1-indexed, like sheet.col_values)."""
+    return [row[col - 1] if len(row) >= col else '' for row in _get_all_values_cached()]
+
+def _invalidate_sheet_cache():
+    _sheet_cache['gen'] += 1  # Marks in-flight fetches stale so they don't resurrect a pre-write snapshot
+    _sheet_cache['ts'] = 0.0  # Force a re-fetch on the next read
+
+async def _sheet_call(fn, *args, **kwargs):
+    """Run a blocking gspread call in a worker thread so one slow Sheets
+    request doesn't stall the event loop for every other chat."""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+# Per-chat locks: with concurrent_updates(True) two updates from the same
+# chat can be in flight at once; these keep same-chat writes ordered while
+# different chats proceed in parallel. Bounded by the ALLOWED_USER_IDS whitelist.
+_chat_locks = {}
+
+def _chat_lock(chat_id) -> asyncio.Lock:
+    return _chat_locks.setdefault(chat_id, asyncio.Lock())
+
 # --- Authorization Decorator ---
 def authorized_user(func):
     async def wrapper(update, context, *args, **kwargs):
@@ -55,7 +133,8 @@ def authorized_user(func):
         if user_id not in ALLOWED_USER_IDS:
             instruction_message = "To get access, ask bot administrator to add your User ID: " \
                                   f"`{user_id}` to the `ALLOWED_USER_IDS` array in `config.json` file."
-            await update.message.reply_text(f"Unauthorized access. {instruction_message}", parse_mode=telegram.constants.ParseMode.MARKDOWN)
+            if update.effective_message: # effective_message also covers callback queries
+                await update.effective_message.reply_text(f"Unauthorized access. {instruction_message}", parse_mode=telegram.constants.ParseMode.MARKDOWN)
             logger.warning(f"Unauthorized user {user_id} tried to access {func.__name__}")
             return
         return await func(update, context, *args, **kwargs)
@@ -64,32 +143,56 @@ def authorized_user(func):
 # --- Function to write data to Google Sheets ---
 def write_to_sheet(item, price, category=None):
     now = datetime.datetime.now()
-    date = now.strftime("%Y-%m-%d")
-    time = now.strftime("%H:%M:%S")
-    next_row = len(list(filter(None, sheet.col_values(1)))) + 1  # Find next empty row
+    date, time = now.isoformat(sep=' ', timespec='seconds').split(' ') # Same "%Y-%m-%d" / "%H:%M:%S" strings, one C call
     row_values = [date, time, item, price, category]
-    sheet.insert_row(row_values, next_row)
-
-# --- Function to get spending summary ---
-def get_spending_summary(period: str, category=None, top_amount=None) -> str:
-    """
-    Calculates the total spending for a given period (day, week, or month) from a Google Sheet,
-    optionally filtered by category and showing top spendings.
-    Returns: str: Spending summary message.
+    sheet.append_row(row_values)  # Server-side append, single API call; RAW keeps dates as ISO text like all existing rows
+    _invalidate_sheet_cache()
+
+# --- Server-side Period Totals ---
+# Helper cells G1:G3 hold SUMIFS formulas so Google computes day/week/month
+# totals for us; reading them back is a 3-cell fetch instead of the full sheet.
+# Column A holds ISO date *text* (insert_row/append_row write RAW), so the
+# criteria compare strings — lexicographic order equals date order for ISO.
+_SUMMARY_FORMULAS = [
+    ['=SUMIFS(D:D, A:A, ">="&TEXT(TODAY(),"yyyy-mm-dd"))'],
+    ['=SUMIFS(D:D, A:A, ">="&TEXT(TODAY()-WEEKDAY(TODAY(),3),"yyyy-mm-dd"))'],
+    ['=SUMIFS(D:D, A:A, ">="&TEXT(DATE(YEAR(TODAY()),MONTH(TODAY()),1),"yyyy-mm-dd"))'],
+]
+_PERIOD_TOTAL_INDEX = {'day': 0, 'week': 1, 'month': 2}
+_summary_formulas_written = False
+
+def _get_period_total(period: str):
+    """Fetch the pre-computed total for a period from the formula cells.
+
+    Writes the formulas on first use. Returns None if the cells cannot be
+    written or read, so the caller can fall back to summing rows locally.
     """
+    global _summary_formulas_written
     try:
-        raw_data: List[List[str]] = sheet.get_all_values()
+        if not _summary_formulas_written:
+            sheet.update(range_name='G1:G3', values=_SUMMARY_FORMULAS, raw=False)
+            _summary_formulas_written = True
+        values = sheet.batch_get(['G1:G3'])[0]
+        return float(values[_PERIOD_TOTAL_INDEX[period]][0])
     except Exception as e:
-        logger.error(f"Failed to fetch data from the sheet: {e}")
-        return "Error fetching data."
-
-    if not raw_data or len(raw_data) <= 1:  # Assume first row is header or sheet is empty
-        return "No spending data available."
-
-    rows = raw_data[1:] # Skip header row if exists, assuming header is in the first row
-    today = datetime.date.today()
+        logger.warning(f"Server-side period total unavailable, summing locally: {e}")
+        return None
+
+# --- Row Filtering for Reports ---
+class Spend(NamedTuple):
+    """One matched expense row; tuple storage keeps large reports compact."""
+    name: str
+    price: float
+    category: Optional[str]
+    date: datetime.date
+
+def _collect_spending_items(rows, period, category, today):
+    """Pure-Python row pass: parse, filter by period/category, total up."""
     period_total = 0.0
     spending_items = []
+    target = f",{category.strip().lower().replace(' ', '')}," if category else None # Normalized once; comma-delimited for exact-token matching
+    start_of_week = today - datetime.timedelta(days=today.weekday()) if period == 'week' else None # Loop invariants, computed once
+    year, month = today.year, today.month
 
     for row in rows:
         if len(row) < 5: # Ensure row has enough columns
@@ -102,44 +205,129 @@ def get_spending_summary(period: str, category=None, top_amount=None) -> str:
             date_obj = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
             price = float(price_str)
 
-            if category and category.lower() not in [cat.strip().lower() for cat in (row_category or "").split(',')]: #Check if row category contains requested category
+            if target and target not in f",{(row_category or '').lower().replace(' ', '')},": #Check if row category contains requested category
                 continue
 
             in_period = False
             if period == 'day' and date_obj == today:
                 in_period = True
-            elif period == 'week':
-                start_of_week = today - datetime.timedelta(days=today.weekday())
-                if start_of_week <= date_obj <= today:
-                    in_period = True
-            elif period == 'month' and date_obj.year == today.year and date_obj.month == today.month:
+            elif period == 'week' and start_of_week <= date_obj <= today:
+                in_period = True
+            elif period == 'month' and date_obj.year == year and date_obj.month == month:
                 in_period = True
 
             if in_period:
                 period_total += price
-                spending_items.append({'name': item_name, 'price': price, 'category': row_category, 'date': date_obj})
+                spending_items.append(Spend(item_name, price, row_category, date_obj))
 
         except (ValueError, IndexError) as e:
             logger.warning(f"Skipping invalid row {row}: {e}")
 
+    return period_total, spending_items
+
+def _collect_spending_items_pandas(rows, period, category, today):
+    """Vectorized row pass: same result as _collect_spending_items, but the
+    parsing and filtering run as C-level pandas operations instead of a
+    per-row Python loop."""
+    df = pd.DataFrame([row[:5] for row in rows if len(row) >= 5],
+                      columns=['date', 'time', 'name', 'price', 'category'])
+    df['date'] = pd.to_datetime(df['date'].str.strip(), format='%Y-%m-%d', errors='coerce')
+    df['price'] = pd.to_numeric(df['price'].str.strip(), errors='coerce')
+    df['name'] = df['name'].str.strip()
+    df['category'] = df['category'].fillna('').str.strip()
+    df = df.dropna(subset=['date', 'price'])
+
+    if period == 'day':
+        mask = df['date'] == pd.Timestamp(today)
+    elif period == 'week':
+        start_of_week = today - datetime.timedelta(days=today.weekday())
+        mask = (df['date'] >= pd.Timestamp(start_of_week)) & (df['date'] <= pd.Timestamp(today))
+    elif period == 'month':
+        mask = (df['date'].dt.year == today.year) & (df['date'].dt.month == today.month)
+    else:
+        mask = pd.Series(False, index=df.index)
+
+    if category:
+        # Exact category-token match with the same normalization as the
+        # Python loop: lowercase, all spaces dropped, comma-delimited
+        target = f",{category.strip().lower().replace(' ', '')},"
+        haystack = ',' + df['category'].str.lower().str.replace(' ', '', regex=False) + ','
+        mask &= haystack.str.contains(target, regex=False)
+
+    selected = df[mask]
+    period_total = float(selected['price'].sum())
+    spending_items = [
+        Spend(t.name, float(t.price), t.category or None, t.date.date())
+        for t in selected.itertuples(index=False)
+    ]
+    return period_total, spending_items
+
+# --- Function to get spending summary ---
+def get_spending_summary(period: str, category=None, top_amount=None) -> str:
+    """
+    Calculates the total spending for a given period (day, week, or month) from a Google Sheet,
+    optionally filtered by category and showing top spendings.
+    Returns: str: Spending summary message.
+    """
+    if category is None and top_amount is None:
+        # Plain total: let the SUMIFS helper cells do the work server-side,
+        # no row download or per-row parsing needed.
+        period_total = _get_period_total(period)
+        if period_total is not None:
+            if period_total == 0:
+                return f"No spendings recorded for this {period}."
+            return f"Total for {period}: {period_total:.2f}{divider_symbol}"
+
+    try:
+        raw_data: List[List[str]] = _get_all_values_cached()
+    except Exception as e:
+        logger.error(f"Failed to fetch data from the sheet: {e}")
+        return "Error fetching data."
+
+    if not raw_data or len(raw_data) <= 1:  # Assume first row is header or sheet is empty
+        return "No spending data available."
+
+    rows = raw_data[1:] # Skip header row if exists, assuming header is in the first row
+    today = datetime.date.today()
+
+    if pd is not None:
+        period_total, spending_items = _collect_spending_items_pandas(rows, period, category, today)
+    else:
+        period_total, spending_items = _collect_spending_items(rows, period, category, today)
+
     if not spending_items:
         return f"No spendings recorded for this {period}{f' in {category}' if category else ''}."
 
-    spending_items.sort(key=lambda x: x['price'], reverse=True) # Sort by price
-
-    if top_amount and top_amount < len(spending_items):
-        spending_items = spending_items[:top_amount]
+    if top_amount:
+        spending_items = heapq.nlargest(top_amount, spending_items, key=lambda x: x.price) # O(N log k), no full sort
+    else:
+        spending_items.sort(key=lambda x: x.price, reverse=True) # Sort by price
 
-    summary_message = f"Spending for {period}{f' in {category}' if category else ''}:\n"
+    lines = [f"Spending for {period}{f' in {category}' if category else ''}:"]
     for item in spending_items:
-        days_ago = (today - item['date']).days
-        date_display = f"{days_ago} day{'s' if days_ago != 1 else ''} ago" if period == 'day' else item['date'].strftime("%Y-%m-%d")
-        summary_message += f"- {item['name']} ({item['category'] or 'N/A'}): {item['price']:.2f}{divider_symbol} ({date_display})\n"
-    summary_message += f"\nTotal for {period}: {period_total:.2f}{divider_symbol}"
+        days_ago = (today - item.date).days
+        date_display = f"{days_ago} day{'s' if days_ago != 1 else ''} ago" if period == 'day' else item.date.strftime("%Y-%m-%d")
+        lines.append(f"- {item.name} ({item.category or 'N/A'}): {item.price:.2f}{divider_symbol} ({date_display})")
+    lines.append(f"\nTotal for {period}: {period_total:.2f}{divider_symbol}")
 
-    return summary_message
+    return "\n".join(lines)
 
 
+# --- Category Cache ---
+_categories_cache = {'set': None, 'rev': 0}  # Unique category names; filled on first use, mutated in place afterwards ('rev' bumps on every mutation)
+
+def _get_categories() -> set:
+    """Return the set of known category names, fetching column E only once."""
+    if _categories_cache['set'] is None:
+        categories = set()
+        for cell_value in _col_values_cached(5):
+            if cell_value:
+                for cat in cell_value.split(','):
+                    if cat.strip():
+                        categories.add(cat.strip())
+        _categories_cache['set'] = categories
+    return _categories_cache['set']
+
 # --- Category Management ---
 @authorized_user
 async def add_category(update, context):
@@ -147,13 +335,20 @@ async def add_category(update, context):
         await update.message.reply_text("Please provide a category name to add. Example: /addcat Groceries")
         return
     category_name = " ".join(context.args)
-    categories_col = sheet.col_values(5)
-    if category_name.lower() in [cat.strip().lower() for cell in categories_col if cell for cat in cell.split(',')]: # Check if category already exists (case-insensitive)
+    categories = await _sheet_call(_get_categories)
+    if category_name.lower() in {cat.lower() for cat in categories}: # Check if category already exists (case-insensitive)
         await update.message.reply_text(f"Category '{category_name}' already exists.")
         return
 
-    categories_row = len(list(filter(None, sheet.col_values(5)))) + 1
-    sheet.update_cell(categories_row, 5, category_name) # Add category to the end of category column
+    # values.append would detect the contiguous A:E table and drop the value in
+    # column A, so target the row after the last used E cell explicitly. The
+    # column comes from the TTL cache, so this still avoids a dedicated fetch.
+    categories_col = await _sheet_call(_col_values_cached, 5)
+    categories_row = max((i + 1 for i, cell in enumerate(categories_col) if cell), default=0) + 1
+    await _sheet_call(sheet.batch_update, [{'range': f'E{categories_row}', 'values': [[category_name]]}]) # Add category to the end of category column
+    _invalidate_sheet_cache()
+    categories.add(category_name)
+    _categories_cache['rev'] += 1
     await update.message.reply_text(f"Category '{category_name}' added.")
 
 @authorized_user
@@ -162,7 +357,7 @@ async def remove_category(update, context):
         await update.message.reply_text("Please provide a category name to remove. Example: /removecat Groceries")
         return
     category_name = " ".join(context.args)
-    categories_col = sheet.col_values(5)
+    categories_col = await _sheet_call(_col_values_cached, 5)
     found = False
     for i, cell_value in enumerate(categories_col):
         if cell_value:
@@ -170,7 +365,11 @@ async def remove_category(update, context):
             if category_name in categories_in_cell:
                 categories_in_cell.remove(category_name)
                 updated_cell_value = ", ".join(categories_in_cell)
-                sheet.update_cell(i+1, 5, updated_cell_value) # Update the cell, i+1 because lists are 0-indexed and sheets are 1-indexed
+                await _sheet_call(sheet.batch_update, [{'range': f'E{i+1}', 'values': [[updated_cell_value]]}]) # Update the cell, i+1 because lists are 0-indexed and sheets are 1-indexed
+                _invalidate_sheet_cache()
+                if _categories_cache['set'] is not None: # Only mutate an already-built set; _get_categories here could fetch on the event loop
+                    _categories_cache['set'].discard(category_name)
+                _categories_cache['rev'] += 1
                 found = True
                 break # Assuming each category name is unique across all cells
     if found:
@@ -186,7 +385,7 @@ async def edit_category(update, context):
     old_category_name = context.args[0]
     new_category_name = " ".join(context.args[1:])
 
-    categories_col = sheet.col_values(5)
+    categories_col = await _sheet_call(_col_values_cached, 5)
     found = False
     for i, cell_value in enumerate(categories_col):
         if cell_value:
@@ -194,7 +393,12 @@ async def edit_category(update, context):
             if old_category_name in categories_in_cell:
                 categories_in_cell = [new_category_name if cat == old_category_name else cat for cat in categories_in_cell] # Replace old with new
                 updated_cell_value = ", ".join(categories_in_cell)
-                sheet.update_cell(i+1, 5, updated_cell_value)
+                await _sheet_call(sheet.batch_update, [{'range': f'E{i+1}', 'values': [[updated_cell_value]]}])
+                _invalidate_sheet_cache()
+                if _categories_cache['set'] is not None: # Only mutate an already-built set; _get_categories here could fetch on the event loop
+                    _categories_cache['set'].discard(old_category_name)
+                    _categories_cache['set'].add(new_category_name)
+                _categories_cache['rev'] += 1
                 found = True
                 break
     if found:
@@ -248,19 +452,19 @@ async def set_divider_command(update, context):
 @authorized_user
 async def day_spending_command(update, context):
     category = " ".join(context.args) if context.args else None
-    report = get_spending_summary('day', category=category)
+    report = await _sheet_call(get_spending_summary, 'day', category=category)
     await update.message.reply_text(report)
 
 @authorized_user
 async def week_spending_command(update, context):
     category = " ".join(context.args) if context.args else None
-    report = get_spending_summary('week', category=category)
+    report = await _sheet_call(get_spending_summary, 'week', category=category)
     await update.message.reply_text(report)
 
 @authorized_user
 async def month_spending_command(update, context):
     category = " ".join(context.args) if context.args else None
-    report = get_spending_summary('month', category=category)
+    report = await _sheet_call(get_spending_summary, 'month', category=category)
     await update.message.reply_text(report)
 
 @authorized_user
@@ -285,57 +489,60 @@ async def help_command(update, context):
     await update.message.reply_text(help_text)
 
 # --- Category Buttons and Expense Tracking ---
+_markup_cache = {'markup': None, 'rev': -1}  # Built keyboard, reused until the categories change
+
+@authorized_user
 async def category_buttons(update, context):
-    categories = sheet.col_values(5) # Get all category cells
-    unique_categories = set()
-    for cell_value in categories:
-        if cell_value:
-            for cat in cell_value.split(','):
-                unique_categories.add(cat.strip())
-    category_list = sorted(list(unique_categories))
-
-    keyboard = []
-    row_buttons = []
-    for cat in category_list:
-        row_buttons.append(InlineKeyboardButton(cat, callback_data=f'set_cat_{cat}'))
-        if len(row_buttons) == 3: # Limit to 3 buttons per row for better UI
+    if _markup_cache['markup'] is None or _markup_cache['rev'] != _categories_cache['rev']:
+        category_list = sorted(await _sheet_call(_get_categories))
+
+        keyboard = []
+        row_buttons = []
+        for cat in category_list:
+            row_buttons.append(InlineKeyboardButton(cat, callback_data=f'set_cat_{cat}'))
+            if len(row_buttons) == 3: # Limit to 3 buttons per row for better UI
+                keyboard.append(row_buttons)
+                row_buttons = []
+        if row_buttons: # Add remaining buttons
             keyboard.append(row_buttons)
-            row_buttons = []
-    if row_buttons: # Add remaining buttons
-        keyboard.append(row_buttons)
-    keyboard.append([InlineKeyboardButton("No Category", callback_data='set_cat_None')]) # Option for no category
+        keyboard.append([InlineKeyboardButton("No Category", callback_data='set_cat_None')]) # Option for no category
+
+        _markup_cache['markup'] = InlineKeyboardMarkup(keyboard)
+        _markup_cache['rev'] = _categories_cache['rev']
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Choose a category for your expense:", reply_markup=reply_markup)
+    await update.message.reply_text("Choose a category for your expense:", reply_markup=_markup_cache['markup'])
 
+@authorized_user
 async def set_category_callback(update, context):
     query = update.callback_query
     await query.answer()
-    category_name = query.data[len('set_cat_'):] # Extract category name from callback data
-    context.user_data['current_category'] = category_name if category_name != 'None' else None # Store selected category in user_data
-    cat_display_name = category_name if category_name != 'None' else 'No Category'
-    await query.edit_message_text(f"Category '{cat_display_name}' selected. Now send your expense (e.g., Item{divider_symbol}Price).")
+    async with _chat_lock(update.effective_chat.id): # Don't race a concurrent expense write from the same chat
+        category_name = query.data[len('set_cat_'):] # Extract category name from callback data
+        context.user_data['current_category'] = category_name if category_name != 'None' else None # Store selected category in user_data
+        cat_display_name = category_name if category_name != 'None' else 'No Category'
+        await query.edit_message_text(f"Category '{cat_display_name}' selected. Now send your expense (e.g., Item{divider_symbol}Price).")
 
 # --- Message Handler for Expense Tracking ---
 @authorized_user
 async def track_expense(update, context):
     message_text = update.message.text
-    category = context.user_data.get('current_category') # Retrieve selected category
-    try:
-        parts = message_text.split(divider_symbol)
-        if len(parts) != 2:
-            raise ValueError("Incorrect format")
-        item = parts[0].strip()
-        price = float(parts[1].strip())
-        write_to_sheet(item, price, category)
-        category_display = f" in category '{category}'" if category else ""
-        await update.message.reply_text(f'Expense tracked: {item} - {price:.2f}{divider_symbol}{category_display}')
-        context.user_data.pop('current_category', None) # Clear category after use
-    except ValueError:
-        await update.message.reply_text(f'Incorrect format. Please use: Item {divider_symbol}Price (e.g., Coffee {divider_symbol}10)')
-    except Exception as e:
-        logger.error(f"Error tracking expense: {e}")
-        await update.message.reply_text('An error occurred. Please try again.')
+    async with _chat_lock(update.effective_chat.id): # Keep expenses from the same chat ordered
+        category = context.user_data.get('current_category') # Retrieve selected category
+        try:
+            item, sep, price_str = message_text.rpartition(divider_symbol) # Split on the last divider so items may contain it
+            if not sep:
+                raise ValueError("Incorrect format")
+            item = item.strip()
+            price = float(price_str.strip())
+            await _sheet_call(write_to_sheet, item, price, category)
+            category_display = f" in category '{category}'" if category else ""
+            await update.message.reply_text(f'Expense tracked: {item} - {price:.2f}{divider_symbol}{category_display}')
+            context.user_data.pop('current_category', None) # Clear category after use
+        except ValueError:
+            await update.message.reply_text(f'Incorrect format. Please use: Item {divider_symbol}Price (e.g., Coffee {divider_symbol}10)')
+        except Exception as e:
+            logger.error(f"Error tracking expense: {e}")
+            await update.message.reply_text('An error occurred. Please try again.')
 
 # --- Callback Query Handlers ---
 async def callback_query_handler(update, context):
@@ -366,30 +573,33 @@ async def error(update, context):
 
 
 # --- Main Function ---
-def main():
-    app = Application.builder().token(BOT_TOKEN).build()
-
-    # Define bot commands for menu using BotCommand objects
-    bot_commands = [
-        BotCommand(command='start', description='Start the bot and show bot description and commands'),
-        BotCommand(command='help', description='Show help message'),
-        BotCommand(command='day', description='Get spending for today'),
-        BotCommand(command='week', description='Get spending for this week'),
-        BotCommand(command='month', description='Get spending for this month'),
-        BotCommand(command='setdivider', description='Set divider symbol'),
-        BotCommand(command='addcat', description='Add category'),
-        BotCommand(command='removecat', description='Remove category'),
-        BotCommand(command='editcat', description='Edit category'),
-        BotCommand(command='categories', description='Show category buttons'),
-    ]
-
-    # Use set_my_commands to configure the bot's commands menu in Telegram
+# Bot commands for the Telegram menu, applied once at startup via post_init
+BOT_COMMANDS = [
+    BotCommand(command='start', description='Start the bot and show bot description and commands'),
+    BotCommand(command='help', description='Show help message'),
+    BotCommand(command='day', description='Get spending for today'),
+    BotCommand(command='week', description='Get spending for this week'),
+    BotCommand(command='month', description='Get spending for this month'),
+    BotCommand(command='setdivider', description='Set divider symbol'),
+    BotCommand(command='addcat', description='Add category'),
+    BotCommand(command='removecat', description='Remove category'),
+    BotCommand(command='editcat', description='Edit category'),
+    BotCommand(command='categories', description='Show category buttons'),
+]
+
+async def _post_init(app):
+    # set_my_commands is a coroutine in PTB v20+; calling it synchronously never ran
     try:
-        app.bot.set_my_commands(bot_commands)
+        await app.bot.set_my_commands(BOT_COMMANDS)
         logger.info("Bot commands set successfully using setMyCommands.")
     except Exception as e:
         logger.error(f"Failed to set bot commands using setMyCommands: {e}")
 
+def main():
+    # concurrent_updates lets handlers overlap; without it PTB processes the
+    # update queue sequentially and one slow Sheets call stalls every chat
+    app = Application.builder().token(BOT_TOKEN).post_init(_post_init).concurrent_updates(True).build()
+
     # Command handlers
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
@@ -410,7 +620,17 @@ def main():
 
     app.add_error_handler(error)
 
-    app.run_polling()
+    if WEBHOOK_URL:
+        # Webhooks deliver updates push-style and in parallel, avoiding the
+        # single in-flight getUpdates request that throttles polling under load.
+        app.run_webhook(
+            listen='0.0.0.0',
+            port=WEBHOOK_PORT,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file